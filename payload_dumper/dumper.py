@@ -5,39 +5,207 @@ import hashlib
 import bz2
 import sys
 import argparse
+import ctypes
+import errno
 import bsdiff4
-import io
+import importlib.util
 import os
 from enlighten import get_manager
 import lzma
+import mmap
+import threading
 from multiprocessing import cpu_count
+from collections import namedtuple
+from itertools import accumulate
+from operator import attrgetter, eq
 from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# prefer the C++ protobuf backend when it is installed
+try:
+    if importlib.util.find_spec("google.protobuf.pyext._message") is not None:
+        os.environ.setdefault("PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION", "cpp")
+except ImportError:
+    pass
+
 import update_metadata_pb2 as um
 import zipfile
 import http_file
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+HAS_COPY_FILE_RANGE = hasattr(os, "copy_file_range")
 
-def u32(x):
-    return struct.unpack(">I", x)[0]
+DECOMPRESS_CHUNK = 1 << 20
+PROGRESS_BATCH = 64
 
+# http: blobs fetched together in ranges, a few groups ahead
+HTTP_FETCH_SIZE = 8 << 20
+HTTP_PREFETCH = 4
+HTTP_CONNECTIONS = 8
 
-def u64(x):
-    return struct.unpack(">Q", x)[0]
+# a fresh decoder per operation
+DECOMPRESSORS = {
+    um.InstallOperation.REPLACE_XZ: lzma.LZMADecompressor,
+    um.InstallOperation.REPLACE_BZ: bz2.BZ2Decompressor,
+}
 
 
-def verify_contiguous(exts):
-    blocks = 0
+_fallocate = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+        _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    except (OSError, AttributeError):
+        _fallocate = None
+
+
+_U32 = struct.Struct(">I").unpack_from
+_U64 = struct.Struct(">Q").unpack_from
+
+
+def u32(x, offset=0):
+    return _U32(x, offset)[0]
+
+
+def u64(x, offset=0):
+    return _U64(x, offset)[0]
+
+
+def preallocate(fd, runs):
+    # reserve the runs that will be written up front
+    if _fallocate is None:
+        return False
+    for offset, length in runs:
+        if _fallocate(fd, 0, offset, length) != 0:
+            err = ctypes.get_errno()
+            if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+                return False
+            raise OSError(err, os.strerror(err))
+    return True
+
+
+def coalesce(exts, block_size):
+    # extents -> (offset, length) byte runs
+    runs = []
     for ext in exts:
-        if ext.start_block != blocks:
-            return False
+        offset = ext.start_block * block_size
+        length = ext.num_blocks * block_size
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1] + length)
+        else:
+            runs.append((offset, length))
+    return runs
+
+
+def merge_runs(runs):
+    # sorted byte runs with touching ones joined
+    merged = []
+    for offset, length in sorted(runs):
+        if merged and merged[-1][0] + merged[-1][1] >= offset:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1] = (merged[-1][0], end - merged[-1][0])
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def pair_runs(src_runs, dst_runs):
+    # (src, dst, length) pieces contiguous on both sides
+    pairs = []
+    dst_runs = iter(dst_runs)
+    dst, dst_len = 0, 0
+    for src, src_len in src_runs:
+        while src_len:
+            if not dst_len:
+                dst, dst_len = next(dst_runs)
+            n = min(src_len, dst_len)
+            pairs.append((src, dst, n))
+            src += n
+            src_len -= n
+            dst += n
+            dst_len -= n
+    return pairs
+
+
+# InstallOperation fields with extents as byte runs
+Operation = namedtuple(
+    "Operation",
+    ["type", "data_offset", "data_length", "data_sha256_hash", "src_runs", "dst_runs"],
+)
+
+
+def extract_op(op, block_size):
+    return Operation(
+        op.type,
+        op.data_offset,
+        op.data_length,
+        op.data_sha256_hash,
+        coalesce(op.src_extents, block_size),
+        coalesce(op.dst_extents, block_size),
+    )
+
 
-        blocks += ext.num_blocks
+def first_src_offset(op):
+    return min((src for src, _ in op.src_runs), default=0)
 
+
+def will_need(fd, runs):
+    # start async readahead for exactly the ranges about to be touched
+    if HAS_FADVISE:
+        for offset, length in runs:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+
+def copy_range(src_fd, dst_fd, src, dst, length):
+    # False tells the caller to copy it itself
+    if not HAS_COPY_FILE_RANGE:
+        return False
+    try:
+        while length:
+            n = os.copy_file_range(src_fd, dst_fd, length, src, dst)
+            if n == 0:
+                return False
+            src += n
+            dst += n
+            length -= n
+    except OSError:
+        return False
     return True
 
 
+def decompress_into(dec, data, out_map, runs):
+    # decode in bounded chunks straight into the runs
+    runs = iter(runs)
+    offset, room = 0, 0
+    while not dec.eof:
+        chunk = dec.decompress(data, max_length=DECOMPRESS_CHUNK)
+        if not chunk and dec.needs_input:
+            raise EOFError("Compressed data ended before the end-of-stream marker was reached")
+        data = b""
+        chunk = memoryview(chunk)
+        while chunk:
+            if not room:
+                offset, room = next(runs, (None, 0))
+                if offset is None:
+                    raise ValueError("decompressed data is longer than the destination extents")
+            n = min(room, len(chunk))
+            out_map[offset:offset + n] = chunk[:n]
+            offset += n
+            room -= n
+            chunk = chunk[n:]
+    if room or next(runs, None) is not None:
+        raise ValueError("decompressed data is shorter than the destination extents")
+
+
+def verify_contiguous(exts):
+    # map/accumulate keep the walk in C
+    starts = map(attrgetter("start_block"), exts)
+    expected = accumulate(map(attrgetter("num_blocks"), exts), initial=0)
+    return all(map(eq, starts, expected))
+
+
 class Dumper:
     def __init__(
             self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count()
@@ -52,6 +220,18 @@ class Dumper:
         self.old = old
         self.images = images
         self.workers = workers
+        self.payload_lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.fetch_pool = None
+        # op type -> handler
+        self.op_handlers = {
+            um.InstallOperation.REPLACE: self.replace_op,
+            um.InstallOperation.REPLACE_XZ: self.decompress_op,
+            um.InstallOperation.REPLACE_BZ: self.decompress_op,
+            um.InstallOperation.SOURCE_COPY: self.source_copy_op,
+            um.InstallOperation.SOURCE_BSDIFF: self.source_bsdiff_op,
+            um.InstallOperation.ZERO: self.zero_op,
+        }
         try:
             self.parse_metadata()
         except AssertionError:
@@ -61,6 +241,15 @@ class Dumper:
             self.parse_metadata()
             pass
 
+        # plain local files are read with pread()
+        self.payload_path = None
+        if hasattr(os, "pread"):
+            try:
+                self.payloadfile.fileno()
+                self.payload_path = self.payloadfile.name
+            except (AttributeError, OSError):
+                pass
+
     def update_download_progress(self, prog, total):
         if self.download_progress is None and prog != total:
             self.download_progress = self.manager.counter(
@@ -68,6 +257,7 @@ class Dumper:
                 desc="download",
                 unit="b", leave=False)
         if self.download_progress is not None:
+            self.download_progress.total = total
             self.download_progress.update(prog - self.download_progress.count)
             if prog == total:
                 self.download_progress.close()
@@ -93,55 +283,140 @@ class Dumper:
             print("Not operating on any partitions")
             return 0
 
+        is_http = isinstance(self.payloadfile, http_file.HttpFile)
         partitions_with_ops = []
         for partition in partitions:
-            operations = []
-            for operation in partition.operations:
-                self.payloadfile.seek(self.data_offset + operation.data_offset)
-                operations.append(
-                    {
-                        "operation": operation,
-                        "data": self.payloadfile.read(operation.data_length),
-                    }
-                )
+            # read the protobuf fields once
+            operations = [extract_op(op, self.block_size) for op in partition.operations]
+            if self.diff:
+                # walk the old image in order, except over http
+                if is_http:
+                    operations.sort(key=lambda op: (op.data_offset, first_src_offset(op)))
+                else:
+                    operations.sort(key=first_src_offset)
             partitions_with_ops.append(
                 {
-                    "partition": partition,
+                    "name": partition.partition_name,
                     "operations": operations,
                 }
             )
 
+        if is_http:
+            self.plan_fetches(partitions_with_ops)
+            self.fetch_pool = ThreadPoolExecutor(max_workers=min(self.workers, HTTP_CONNECTIONS))
+        try:
+            self.multiprocess_partitions(partitions_with_ops)
+        finally:
+            if self.fetch_pool is not None:
+                self.fetch_pool.shutdown(cancel_futures=True)
         self.payloadfile.close()
-
-        self.multiprocess_partitions(partitions_with_ops)
         self.manager.stop()
 
+    def plan_fetches(self, partitions):
+        # group adjacent blobs in dispatch order
+        self.fetch_groups = []
+        self.fetch_group_of = {}
+        group = None
+        for part in partitions:
+            for op in part["operations"]:
+                if op.data_length == 0:
+                    continue
+                if (
+                    group is None
+                    or op.data_offset != group["offset"] + group["length"]
+                    or group["length"] + op.data_length > HTTP_FETCH_SIZE
+                ):
+                    group = {"offset": op.data_offset, "length": 0, "users": 0, "future": None}
+                    self.fetch_groups.append(group)
+                group["length"] += op.data_length
+                group["users"] += 1
+                self.fetch_group_of[op.data_offset] = len(self.fetch_groups) - 1
+
+    def read_grouped(self, op):
+        index = self.fetch_group_of[op.data_offset]
+        with self.fetch_lock:
+            # prefetch the next few groups
+            for group in self.fetch_groups[index:index + HTTP_PREFETCH]:
+                if group["future"] is None and group["users"]:
+                    group["future"] = self.fetch_pool.submit(
+                        self.payloadfile.pread, self.data_offset + group["offset"], group["length"]
+                    )
+            group = self.fetch_groups[index]
+            future = group["future"]
+
+        try:
+            data = future.result()
+        finally:
+            self.release_group(op)
+        start = op.data_offset - group["offset"]
+        if start == 0 and op.data_length == len(data):
+            return data
+        return data[start:start + op.data_length]
+
+    def release_group(self, op):
+        # drop the group's data once its last operation is done with it
+        if self.fetch_pool is None or op.data_length == 0:
+            return
+        with self.fetch_lock:
+            group = self.fetch_groups[self.fetch_group_of[op.data_offset]]
+            group["users"] -= 1
+            if group["users"] == 0:
+                group["future"] = None
+
     def multiprocess_partitions(self, partitions):
         progress_bars = {}
-
-        def update_progress(partition_name, count):
-            progress_bars[partition_name].update(count)
+        remaining = {}
+        pending = {}
 
         with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            submit = executor.submit
+            data_for_op = self.data_for_op
             for part in partitions:
-                partition_name = part['partition'].partition_name
+                partition_name = part["name"]
                 progress_bars[partition_name] = self.manager.counter(
                     total=len(part["operations"]),
                     desc=f"{partition_name}",
                     unit="ops",
                     leave=True,
                 )
+                try:
+                    self.open_part(part)
+                except Exception as exc:
+                    print(f"{partition_name} - processing generated an exception: {exc}")
+                    self.close_part(part)
+                    progress_bars[partition_name].close()
+                    for op in part["operations"]:
+                        self.release_group(op)
+                    continue
+
+                remaining[partition_name] = len(part["operations"])
+                pending[partition_name] = 0
+                if remaining[partition_name] == 0:
+                    self.close_part(part)
+                    progress_bars[partition_name].close()
 
-            futures = {executor.submit(self.dump_part, part, update_progress): part for part in partitions}
+                for op in part["operations"]:
+                    futures[submit(data_for_op, op, part)] = part
 
             for future in as_completed(futures):
                 part = futures[future]
-                partition_name = part['partition'].partition_name
+                partition_name = part["name"]
                 try:
                     future.result()
-                    progress_bars[partition_name].close()
+                    pending[partition_name] += 1
                 except Exception as exc:
-                    print(f"{partition_name} - processing generated an exception: {exc}")
+                    if not part["failed"]:
+                        print(f"{partition_name} - processing generated an exception: {exc}")
+                    part["failed"] = True
+
+                # update the bar in batches
+                remaining[partition_name] -= 1
+                if pending[partition_name] >= PROGRESS_BATCH or remaining[partition_name] == 0:
+                    progress_bars[partition_name].update(pending[partition_name])
+                    pending[partition_name] = 0
+                if remaining[partition_name] == 0:
+                    self.close_part(part)
                     progress_bars[partition_name].close()
 
     def parse_metadata(self):
@@ -151,15 +426,15 @@ class Dumper:
         magic = buffer[:4]
         assert magic == b"CrAU"
 
-        file_format_version = u64(buffer[4:12])
+        file_format_version = u64(buffer, 4)
         assert file_format_version == 2
 
-        manifest_size = u64(buffer[12:20])
+        manifest_size = u64(buffer, 12)
 
         metadata_signature_size = 0
 
         if file_format_version > 1:
-            metadata_signature_size = u32(buffer[20:24])
+            metadata_signature_size = u32(buffer, 20)
 
         manifest = self.payloadfile.read(manifest_size)
         self.metadata_signature = self.payloadfile.read(metadata_signature_size)
@@ -169,79 +444,150 @@ class Dumper:
         self.dam.ParseFromString(manifest)
         self.block_size = self.dam.block_size
 
-    def data_for_op(self, operation, out_file, old_file):
-        data = operation["data"]
-        op = operation["operation"]
-
-        # assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
-
-        if op.type == op.REPLACE_XZ:
-            dec = lzma.LZMADecompressor()
-            data = dec.decompress(data)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
-        elif op.type == op.REPLACE_BZ:
-            dec = bz2.BZ2Decompressor()
-            data = dec.decompress(data)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
-        elif op.type == op.REPLACE:
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            out_file.write(data)
-        elif op.type == op.SOURCE_COPY:
-            if not self.diff:
-                print("SOURCE_COPY supported only for differential OTA")
-                sys.exit(-2)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                data = old_file.read(ext.num_blocks * self.block_size)
-                out_file.write(data)
-        elif op.type == op.SOURCE_BSDIFF:
-            if not self.diff:
-                print("SOURCE_BSDIFF supported only for differential OTA")
-                sys.exit(-3)
-            out_file.seek(op.dst_extents[0].start_block * self.block_size)
-            tmp_buff = io.BytesIO()
-            for ext in op.src_extents:
-                old_file.seek(ext.start_block * self.block_size)
-                old_data = old_file.read(ext.num_blocks * self.block_size)
-                tmp_buff.write(old_data)
-            tmp_buff.seek(0)
-            old_data = tmp_buff.read()
-            tmp_buff.seek(0)
-            tmp_buff.write(bsdiff4.patch(old_data, data))
-            n = 0
-            tmp_buff.seek(0)
-            for ext in op.dst_extents:
-                tmp_buff.seek(n * self.block_size)
-                n += ext.num_blocks
-                data = tmp_buff.read(ext.num_blocks * self.block_size)
-                out_file.seek(ext.start_block * self.block_size)
-                out_file.write(data)
-        elif op.type == op.ZERO:
-            for ext in op.dst_extents:
-                out_file.seek(ext.start_block * self.block_size)
-                out_file.write(b"\x00" * ext.num_blocks * self.block_size)
-        else:
+    def read_data(self, op, payload_fd=None):
+        length = op.data_length
+        if length == 0:
+            return b""
+        offset = self.data_offset + op.data_offset
+        if payload_fd is not None:
+            return os.pread(payload_fd, length, offset)
+        if self.fetch_pool is not None:
+            return self.read_grouped(op)
+        with self.payload_lock:
+            self.payloadfile.seek(offset)
+            return self.payloadfile.read(length)
+
+    def data_for_op(self, op, part):
+        if part["failed"]:
+            self.release_group(op)
+            return
+        data = self.read_data(op, part["payload_fd"])
+
+        if op.data_sha256_hash:
+            assert hashlib.sha256(data).digest() == op.data_sha256_hash, "operation data hash mismatch"
+
+        handler = self.op_handlers.get(op.type)
+        if handler is None:
             print("Unsupported type = %d" % op.type)
             sys.exit(-1)
-
-        return data
-
-    def dump_part(self, part, update_callback):
-        name = part["partition"].partition_name
-        out_file = open("%s/%s.img" % (self.out, name), "wb")
-        h = hashlib.sha256()
-
-        if self.diff:
-            old_file = open("%s/%s.img" % (self.old, name), "rb")
+        handler(op, data, part)
+
+    def replace_op(self, op, data, part):
+        out_map = part["out_map"]
+        data = memoryview(data)
+        total = sum(length for _, length in op.dst_runs)
+        if len(data) > total:
+            raise ValueError("operation data is longer than the destination extents")
+        if len(data) < total:
+            raise ValueError("operation data is shorter than the destination extents")
+        n = 0
+        for offset, length in op.dst_runs:
+            out_map[offset:offset + length] = data[n:n + length]
+            n += length
+
+    def decompress_op(self, op, data, part):
+        dec = DECOMPRESSORS[op.type]()
+        decompress_into(dec, data, part["out_map"], op.dst_runs)
+
+    def source_copy_op(self, op, data, part):
+        if not self.diff:
+            print("SOURCE_COPY supported only for differential OTA")
+            sys.exit(-2)
+        out_map = part["out_map"]
+        out_fd = part["out_fd"]
+        old_fd = part["old_file"].fileno()
+        src_runs = op.src_runs
+        dst_runs = op.dst_runs
+        will_need(old_fd, src_runs)
+        with memoryview(part["old_map"]) as old_view:
+            for src, dst, length in pair_runs(src_runs, dst_runs):
+                if not copy_range(old_fd, out_fd, src, dst, length):
+                    out_map[dst:dst + length] = old_view[src:src + length]
+
+    def source_bsdiff_op(self, op, data, part):
+        if not self.diff:
+            print("SOURCE_BSDIFF supported only for differential OTA")
+            sys.exit(-3)
+        out_map = part["out_map"]
+        old_map = part["old_map"]
+        src_runs = op.src_runs
+        will_need(part["old_file"].fileno(), src_runs)
+        if len(src_runs) == 1:
+            src, length = src_runs[0]
+            old_data = old_map[src:src + length]
         else:
-            old_file = None
-
-        for op in part["operations"]:
-            data = self.data_for_op(op, out_file, old_file)
-            update_callback(part["partition"].partition_name, 1)
+            # bsdiff4 needs a bytes source
+            with memoryview(old_map) as old_view:
+                old_data = b"".join(old_view[src:src + length] for src, length in src_runs)
+        patched = memoryview(bsdiff4.patch(old_data, data))
+        n = 0
+        for offset, length in op.dst_runs:
+            out_map[offset:offset + length] = patched[n:n + length]
+            n += length
+
+    def zero_op(self, op, data, part):
+        # the image is freshly truncated, so these blocks already read as zeros
+        pass
+
+    def open_part(self, part):
+        name = part["name"]
+        part.update(failed=False, out_fd=None, out_map=None, old_file=None, old_map=None, payload_fd=None)
+        if self.diff:
+            part["old_file"] = open("%s/%s.img" % (self.old, name), "rb")
+            if HAS_FADVISE:
+                os.posix_fadvise(part["old_file"].fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if os.fstat(part["old_file"].fileno()).st_size:
+                part["old_map"] = mmap.mmap(part["old_file"].fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.payload_path is not None:
+            part["payload_fd"] = os.open(self.payload_path, os.O_RDONLY)
+            if HAS_FADVISE:
+                os.posix_fadvise(part["payload_fd"], 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        out_path = "%s/%s.img" % (self.out, name)
+        part["out_fd"] = os.open(
+            out_path,
+            os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+            0o644,
+        )
+
+        size = max(
+            (offset + length for op in part["operations"] for offset, length in op.dst_runs),
+            default=0,
+        )
+        written = merge_runs(
+            run for op in part["operations"] if op.type != um.InstallOperation.ZERO for run in op.dst_runs
+        )
+        try:
+            os.ftruncate(part["out_fd"], size)
+            preallocate(part["out_fd"], written)
+            part["out_map"] = mmap.mmap(part["out_fd"], size) if size else None
+        except OSError:
+            # don't leave a full-size image of zeros behind
+            os.close(part["out_fd"])
+            part["out_fd"] = None
+            os.remove(out_path)
+            raise
+
+    def close_part(self, part):
+        # drop the finished images from the page cache
+        if part["out_map"] is not None:
+            if HAS_FADVISE:
+                part["out_map"].flush()
+            part["out_map"].close()
+        if part["old_map"] is not None:
+            part["old_map"].close()
+        if HAS_FADVISE:
+            if part["out_fd"] is not None:
+                os.posix_fadvise(part["out_fd"], 0, 0, os.POSIX_FADV_DONTNEED)
+            if part["old_file"] is not None:
+                os.posix_fadvise(part["old_file"].fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        if part["old_file"] is not None:
+            part["old_file"].close()
+        for key in ("out_fd", "payload_fd"):
+            if part[key] is not None:
+                os.close(part[key])
 
 
 def main():
@@ -284,6 +630,8 @@ def main():
         payload_file = http_file.HttpFile(payload_file)
     else:
         payload_file = open(payload_file, 'rb')
+        if HAS_FADVISE:
+            os.posix_fadvise(payload_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
     dumper = Dumper(
         payload_file,
@@ -1,5 +1,6 @@
 import io
 import os
+import threading
 
 import httpx
 
@@ -38,6 +39,42 @@ class HttpFile(io.RawIOBase):
         self.pos += size
         return size
 
+    def _report_pread(self, done: int, total: int) -> None:
+        # called with self.lock held; concurrent preads share one counter
+        self.inflight_done += done
+        self.inflight_total += total
+        if self.progress_reporter is not None:
+            self.progress_reporter(self.inflight_done, self.inflight_total)
+        if self.inflight_done == self.inflight_total:
+            self.inflight_done = self.inflight_total = 0
+
+    def pread(self, offset: int, size: int) -> bytes:
+        # thread-safe, leaves self.pos alone
+        if offset < 0 or offset + size > self.size:
+            raise ValueError(f'invalid range {offset}+{size} in size {self.size}')
+        headers = {'Range': f'bytes={offset}-{offset + size - 1}'}
+        with self.lock:
+            self._report_pread(0, size)
+        chunks = []
+        n = 0
+        try:
+            with self.client.stream('GET', self.url, headers=headers) as r:
+                if r.status_code != 206:
+                    raise io.UnsupportedOperation('Remote did not return partial content!')
+                for chunk in r.iter_bytes(8192):
+                    chunks.append(chunk)
+                    n += len(chunk)
+                    with self.lock:
+                        self.total_bytes += len(chunk)
+                        self._report_pread(len(chunk), 0)
+        finally:
+            if n != size:
+                with self.lock:
+                    self._report_pread(size - n, 0)
+        if n != size:
+            raise OSError(f'short read at {offset}: got {n} of {size} bytes')
+        return b"".join(chunks)
+
     def readall(self) -> bytes:
         sz = self.size - self.pos
         buf = bytearray(sz)
@@ -80,6 +117,9 @@ class HttpFile(io.RawIOBase):
         self.size = size
         self.pos = 0
         self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.inflight_done = 0
+        self.inflight_total = 0
         self.progress_reporter = progress_reporter
 
     def close(self) -> None: